@@ -0,0 +1,45 @@
+from asyncio.subprocess import PIPE, STDOUT
+from typing import Any, List
+
+import asyncio
+import shlex
+
+
+async def run(args: List[str], index: int, total: int, verbose: int) -> None:
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=PIPE, stderr=STDOUT
+        )
+        stdout, _ = await process.communicate()
+    except OSError as exc:
+        print(f"command ({shlex.join(args)}) {index + 1} of {total} failed: {exc}")
+        return
+
+    output = stdout.decode(errors="replace")
+    if process.returncode:
+        print(
+            f"command ({shlex.join(args)}) {index + 1} of {total} failed "
+            f"with return code {process.returncode}\n{output}",
+        )
+    elif verbose:
+        print(f"[{index + 1}/{total}] '{shlex.join(args)}' {output}")
+
+
+async def run_all(data: List[Any], threads: int, verbose: int) -> None:
+    total = len(data)
+    commands = enumerate(entry["arguments"] for entry in data)
+
+    # Each worker pulls the next command once its compiler exits so that at
+    # most `threads` compilers run at the same time
+    async def worker() -> None:
+        for index, args in commands:
+            await run(args, index, total, verbose)
+
+    await asyncio.gather(*(worker() for _ in range(min(threads, total))))
+
+
+def execute(data: List[Any], threads: int, verbose: int) -> None:
+    if verbose:
+        print(f"Executing {len(data)} commands, this may take a while...")
+
+    asyncio.run(run_all(data, threads, verbose))
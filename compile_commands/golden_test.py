@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
+from collections import Counter
 from pathlib import Path
 
 from .main import main
 
 import pytest
-import json
+import orjson
 import os
 
 
+def entries(path: str) -> Counter:
+    # Entries are compared regardless of their order
+    return Counter(
+        frozenset((k, tuple(v) if isinstance(v, list) else v) for k, v in e.items())
+        for e in orjson.loads(Path(path).read_bytes())
+    )
+
+
 @pytest.fixture
 def current_path() -> Path:
     return Path(__file__).parent.resolve()
@@ -34,10 +43,6 @@ def test_golden(current_path):
         ]
     )
 
-    with open(o, "r") as after:
-        with open(i, "r") as before:
-            a = sorted(json.load(after), key=lambda d: d["arguments"])
-            b = sorted(json.load(before), key=lambda d: d["arguments"])
-            assert a == b
+    assert entries(o) == entries(i)
 
     os.remove(o)
@@ -1,24 +1,78 @@
 #!/usr/bin/env python3
 
-from argparse import ArgumentParser, RawTextHelpFormatter
-from importlib.metadata import version
+from argparse import (
+    SUPPRESS,
+    Action,
+    ArgumentParser,
+    ArgumentTypeError,
+    RawTextHelpFormatter,
+)
 from multiprocessing import cpu_count
-from concurrent.futures import ProcessPoolExecutor
-from typing import Optional, Sequence, List, Any
-from subprocess import check_output, STDOUT, CalledProcessError
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import (
+    Optional,
+    Sequence,
+    List,
+    Any,
+    Iterable,
+    Iterator,
+    BinaryIO,
+    Deque,
+    Callable,
+    Dict,
+)
+from collections import deque
+from functools import lru_cache
 from pprint import pprint
-from pathlib import Path
-from glob2 import glob
+from itertools import chain, islice, repeat
+from regex import Pattern
+
+from .transform import (
+    EntryTransform,
+    clang_compiler,
+    filter_command,
+    gcc_compiler,
+    move_compiler,
+    normalize_entry,
+    to_arguments,
+    to_command,
+    transform_chunk,
+    transform_entry,
+    transform_include_directories,
+)
 
 import os
 import sys
-import json
-import shlex
+import mmap
+import atexit
+import hashlib
+import io
+import orjson
+import pickle
+import shutil
+import ijson
 import re
+import regex
+import tempfile
 import time
 import os
 import sys
 
+_REGEX_METACHARACTERS = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+# CDBs bigger than this are memory mapped rather than copied into a buffer
+_MMAP_THRESHOLD = 512 << 10
+# CDBs bigger than this are parsed incrementally instead of being read at once
+_STREAMING_THRESHOLD = 256 << 20
+# Merged CDBs totalling more than this are parsed by worker processes
+_PARALLEL_LOAD_THRESHOLD = 64 << 20
+# Number of entries sent at once to a worker process when transforming big CDBs
+_CHUNK_SIZE = 4096
+
+
+class CDBParseError(Exception):
+    pass
+
 
 def dir_path(path):
     if os.path.isdir(path):
@@ -26,7 +80,41 @@ def dir_path(path):
     raise NotADirectoryError(path)
 
 
+def compile_pattern(pattern: str, flags: int = 0) -> Optional[Pattern]:
+    if not pattern:
+        return None
+    try:
+        return regex.compile(pattern, flags)
+    except regex.error as e:
+        raise ArgumentTypeError(f"invalid regular expression {pattern!r}: {e}")
+
+
+def case_insensitive_pattern(pattern: str) -> Optional[Pattern]:
+    return compile_pattern(pattern, regex.IGNORECASE)
+
+
+class VersionAction(Action):
+    # Importing importlib.metadata and looking up the installed version, which
+    # scans the distributions on sys.path, is only done when --version is passed
+    def __init__(self, option_strings, dest=SUPPRESS, default=SUPPRESS, help=None):
+        super().__init__(
+            option_strings=option_strings,
+            dest=dest,
+            default=default,
+            nargs=0,
+            help=help or "show program's version number and exit",
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from importlib.metadata import version
+
+        print(f"{parser.prog} {version('compile-commands')}")
+        parser.exit()
+
+
 def parse_arguments(argv: Optional[Sequence[str]] = None):
+    cpus = cpu_count()
+
     parser = ArgumentParser(
         description=(
             "Utility to manipulate compilation databases. (CDB)\n"
@@ -39,8 +127,7 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
     parser.add_argument(
         "-V",
         "--version",
-        action="version",
-        version=f"%(prog)s {version('compile-commands')}",
+        action=VersionAction,
     )
 
     parser.add_argument(
@@ -54,7 +141,6 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
     location_group = parser.add_mutually_exclusive_group(required=True)
     location_group.add_argument(
         "--dir",
-        default=os.getcwd(),
         type=dir_path,
         help="path to target directory containing a compilation database",
     )
@@ -79,7 +165,19 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
         help=(
             "find all compile-commands.json files in --dir recursively and merges them,"
             "\nif not set only the CDB in the root directory will be considered"
-            "\nnote that it may be relatively slow for big hierarchies. In which case you should use --files"
+            "\nonly directories are walked, use --cache or --files to skip the walk entirely"
+        ),
+    )
+
+    parser.add_argument(
+        "--cache",
+        default=False,
+        action="store_true",
+        help=(
+            "cache the compilation databases found by --merge and their normalized\n"
+            "entries in ~/.cache/compile-commands, the cache is invalidated as soon as\n"
+            "a directory of the hierarchy or a compilation database changes.\n"
+            "The normalized entries aren't used with --filter"
         ),
     )
 
@@ -113,7 +211,6 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
         "-o",
         "--output",
         type=str,
-        default=os.getcwd() + "/compile_commands.json",
         help=(
             "output path for the generated compilation database file.\n"
             "defaults to compile_commands.json within the current working directory\n"
@@ -123,6 +220,13 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
         ),
     )
 
+    output_group.add_argument(
+        "--pretty",
+        default=False,
+        action="store_true",
+        help="indent the output and sort the keys of each entry",
+    )
+
     output_group.add_argument(
         "--command",
         default=False,
@@ -165,13 +269,16 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
         "--remove_duplicates",
         default=False,
         action="store_true",
-        help="prevent the same translation unit from appearing twice in the CDB.",
+        help=(
+            "prevent the same translation unit from appearing twice in the CDB.\n"
+            "entries are compared on all their fields in a single pass"
+        ),
     )
 
     regex_group = parser.add_argument_group(title="filtering flags")
     regex_group.add_argument(
         "--filter",
-        type=str,
+        type=case_insensitive_pattern,
         help="regular expression that will filter out matches from each command",
     )
 
@@ -184,14 +291,13 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
 
     regex_group.add_argument(
         "--filter_files",
-        type=str,
+        type=case_insensitive_pattern,
         help="regular expression that will filter out matching files",
     )
 
     regex_group.add_argument(
         "--filter_include_directories",
-        default="",
-        type=str,
+        type=compile_pattern,
         help=(
             "regular expression that will filter out matching include directories\n"
             "This applies before AND after --absolute_include_directories"
@@ -209,9 +315,8 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
     execution_group.add_argument(
         "-j",
         "--threads",
-        help=f"number of threads for --run, defaults to multiprocessing.cpu_count() which is {cpu_count()}",
+        help=f"number of threads for --run, defaults to multiprocessing.cpu_count() which is {cpus}",
         type=int,
-        default=cpu_count(),
     )
 
     path_group = parser.add_argument_group(
@@ -233,7 +338,11 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
 
     args = parser.parse_args(argv)
 
-    if args.threads != cpu_count() and not args.run:
+    if args.threads is None:
+        args.threads = cpus
+    elif args.threads < 1:
+        parser.error(f"argument -j/--threads: must be at least 1, got {args.threads}")
+    elif not args.run:
         print(
             "warning: --threads (-j) will be ignored since --run was not passed.",
             file=sys.stderr,
@@ -256,243 +365,467 @@ def parse_arguments(argv: Optional[Sequence[str]] = None):
     return args
 
 
-def get_compile_dbs(directory) -> List[str]:
-    paths: List[str] = list(
-        str(p) for p in glob(f"{os.path.abspath(directory)}/**/compile_commands.json")
-    )
+def get_compile_dbs(
+    directory, directories: Optional[Dict[str, int]] = None
+) -> List[str]:
+    root = os.path.realpath(directory)
 
-    # Since we take into account symlinks we have to make sure the symlinks
-    # doesn't resolve to a file that we already have
-    paths = list(set([os.path.realpath(p) for p in paths]))
+    # Directories are tracked by their real path so that symlinks pointing
+    # back into the hierarchy aren't walked twice (or forever)
+    visited = {root}
+    stack = [root]
+    paths: List[str] = []
+    while stack:
+        current = stack.pop()
 
-    # Making sure to ignore a compile_commands.json in the root directory
-    return [p for p in paths if Path(p).parent.parts[-1] != Path(directory).parts[-1]]
+        # Directories that can't be read or vanished during the walk are skipped
+        try:
+            mtime = os.stat(current).st_mtime_ns
+            with os.scandir(current) as it:
+                entries = list(it)
+        except OSError:
+            continue
+
+        if directories is not None:
+            directories[current] = mtime
+
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in visited:
+                    visited.add(entry.path)
+                    stack.append(entry.path)
+            elif entry.is_symlink() and entry.is_dir():
+                target = os.path.realpath(entry.path)
+                if target not in visited:
+                    visited.add(target)
+                    stack.append(target)
+            elif entry.name == "compile_commands.json" and current != root:
+                # Ignoring the compile_commands.json in the root directory
+                if entry.is_symlink():
+                    paths.append(os.path.realpath(entry.path))
+                else:
+                    paths.append(entry.path)
+
+    return list(dict.fromkeys(paths))
+
+
+def get_cache_path(path: str, extension: str = ".json") -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    key = hashlib.blake2b(path.encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_home, "compile-commands", key + extension)
+
+
+def get_cached_compile_dbs(directory) -> List[str]:
+    cache_path = get_cache_path(os.path.realpath(directory))
+
+    # The cache holds the mtime of every directory walked, adding or removing
+    # a compilation database anywhere in the hierarchy changes one of them
+    try:
+        with open(cache_path, "rb") as cache_file:
+            cache = orjson.loads(cache_file.read())
+        if all(
+            os.stat(d).st_mtime_ns == mtime for d, mtime in cache["directories"].items()
+        ):
+            return cache["paths"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    directories: Dict[str, int] = {}
+    paths = get_compile_dbs(directory, directories)
 
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "wb") as cache_file:
+            cache_file.write(orjson.dumps({"directories": directories, "paths": paths}))
+    except OSError as e:
+        print(f"warning: couldn't write cache {cache_path}: {e}", file=sys.stderr)
 
-def remove_files(data: List[Any], files: List[str]) -> List[Any]:
-    return [d for d in data if d["file"] not in files]
+    return paths
 
 
-def include_files(data: List[Any], files: List[str]) -> List[Any]:
-    return [d for d in data if d["file"] in files]
+def select_files(
+    data: Iterable[Any],
+    removed: Optional[Iterable[str]] = None,
+    included: Optional[Iterable[str]] = None,
+    pattern: Optional[Pattern] = None,
+) -> Iterator[Any]:
+    removed_lookup = frozenset(removed) if removed is not None else None
+    included_lookup = frozenset(included) if included is not None else None
 
+    # Every file filter is applied in a single pass, the set lookups first
+    for entry in data:
+        file = entry["file"]
+        if removed_lookup is not None and file in removed_lookup:
+            continue
+        if included_lookup is not None and file not in included_lookup:
+            continue
+        if pattern and pattern.search(file):
+            continue
+        yield entry
 
-def merge_json_files(paths: List[str]) -> List[Any]:
-    data: List[Any] = []
-    for path in paths:
-        try:
-            with open(str(path), "r") as json_file:
-                data.extend(json.load(json_file))
-        except ValueError as e:
-            print(f"Couldn't parse json file: {path}", file=sys.stderr)
-            print(e, file=sys.stderr)
-            exit(1)
-    return data
 
+def remove_files(data: Iterable[Any], files: Iterable[str]) -> Iterator[Any]:
+    return select_files(data, removed=files)
 
-def add_flags(data: List[Any], flags: str) -> List[Any]:
-    for entry in data:
-        entry["arguments"].extend(flags.split())
-    return data
 
+def include_files(data: Iterable[Any], files: Iterable[str]) -> Iterator[Any]:
+    return select_files(data, included=files)
 
-def change_compiler_path(data: List[Any], new_path: str) -> List[Any]:
-    for entry in data:
-        compiler_path = entry["arguments"][0]
-        compiler = os.path.basename(compiler_path)
-        entry["arguments"][0] = os.path.normpath(new_path) + "/" + compiler
-    return data
 
+def freeze(value: Any) -> Any:
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    return value
 
-def to_clang(data: List[Any]) -> List[Any]:
+
+def remove_duplicates(data: Iterable[Any]) -> Iterator[Any]:
+    seen = set()
     for entry in data:
-        entry["arguments"][0] = (
-            entry["arguments"][0].replace("/gcc", "/clang").replace("/g++", "/clang++")
-        )
-    return data
+        # Entries are compared on all their fields, whatever their order
+        key = freeze(entry)
+        if key not in seen:
+            seen.add(key)
+            yield entry
 
 
-def to_gcc(data: List[Any]) -> List[Any]:
-    for entry in data:
-        entry["arguments"][0] = (
-            entry["arguments"][0].replace("/clang++", "/g++").replace("/clang", "/gcc")
-        )
-    return data
+def load_json_file(path: str) -> Iterator[Any]:
+    try:
+        with open(str(path), "rb") as json_file:
+            size = os.fstat(json_file.fileno()).st_size
+            if size > _STREAMING_THRESHOLD:
+                yield from ijson.items(json_file, "item", use_float=True)
+            elif size > _MMAP_THRESHOLD:
+                with mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as view:
+                        entries = orjson.loads(view)
+                yield from entries
+            else:
+                yield from orjson.loads(json_file.read())
+    except (ValueError, ijson.JSONError) as e:
+        # Raised rather than exiting so that it also reaches the main process
+        # when the file is parsed by a worker
+        raise CDBParseError(f"{path}: {e}") from e
+
 
+def load_cached_json_file(path: str) -> Iterator[Any]:
+    stat = os.stat(path)
+    cache_path = get_cache_path(os.path.realpath(path), ".pickle")
 
-def run(args: List[str], index: int, total: int, verbose: int) -> None:
+    # Normalizing costs much more than parsing, the normalized entries are
+    # kept until the CDB is modified
     try:
-        output = check_output(args, stderr=STDOUT, universal_newlines=True)
-    except CalledProcessError as exc:
-        print(
-            f"command ({shlex.join(args)}) {index + 1} of {total} failed "
-            f"with return code {exc.returncode}\n{exc.output}",
-        )
-    else:
-        if verbose:
-            print(f"[{index + 1}/{total}] '{shlex.join(args)}' {output}")
+        with open(cache_path, "rb") as cache_file:
+            mtime, size, entries = pickle.load(cache_file)
+        if mtime == stat.st_mtime_ns and size == stat.st_size:
+            return iter(entries)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+        pass
+
+    # Streamed CDBs are too big to be held in memory, they aren't cached
+    if stat.st_size > _STREAMING_THRESHOLD:
+        return (normalize_entry(entry) for entry in load_json_file(path))
+
+    entries = [normalize_entry(entry) for entry in load_json_file(path)]
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "wb") as cache_file:
+            pickle.dump(
+                (stat.st_mtime_ns, stat.st_size, entries),
+                cache_file,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    except OSError as e:
+        print(f"warning: couldn't write cache {cache_path}: {e}", file=sys.stderr)
 
+    return iter(entries)
 
-def execute(data: List[Any], threads: int, verbose: int) -> None:
-    total = len(data)
-    if verbose:
-        print(f"Executing {total} commands, this may take a while...")
 
-    with ProcessPoolExecutor(max_workers=threads) as executor:
-        for index, entry in enumerate(data):
-            executor.submit(run, entry["arguments"], index, total, verbose)
+def read_json_file(path: str, cache: bool = False) -> List[Any]:
+    return list(load_cached_json_file(path) if cache else load_json_file(path))
 
 
-def normalize_include_directories(data: List[Any]) -> List[Any]:
-    for entry in data:
-        arguments = entry["arguments"]
-        is_path = True
-        for index, arg in enumerate(arguments):
-            if arg in ("-I", "-isystem", "-iquote", "-idirafter"):
-                is_path = True
-            elif is_path:
-                is_path = False
-                arguments[index] = os.path.normpath(arg)
+@lru_cache(maxsize=None)
+def get_executor(workers: int) -> ProcessPoolExecutor:
+    # Loading and transforming share the same workers rather than each
+    # spawning (and oversubscribing) their own
+    executor = ProcessPoolExecutor(max_workers=workers)
+    atexit.register(executor.shutdown)
+    return executor
 
-    return data
 
+def load_json_files(paths: List[str], cache: bool) -> Iterator[Any]:
+    executor = get_executor(cpu_count())
+    for entries in executor.map(read_json_file, paths, repeat(cache)):
+        yield from entries
 
-def absolute_include_directories(data: List[Any]) -> List[Any]:
-    for entry in data:
-        directory = entry["directory"]
-        arguments = entry["arguments"]
 
-        is_path = False
-        for index, arg in enumerate(arguments):
-            if arg in ("-I", "-isystem", "-iquote", "-idirafter"):
-                is_path = True
-            elif is_path:
-                is_path = False
-                if not os.path.isabs(arg):
-                    arguments[index] = os.path.normpath(os.path.join(directory, arg))
+def merge_json_files(paths: List[str], cache: bool = False) -> Iterator[Any]:
+    # Files are only parsed once iterated over, fail early if one of them is missing
+    sizes = [os.stat(path).st_size for path in paths]
+
+    # Parsing is much slower than sending the entries back from another
+    # process, streamed CDBs are kept in this one to bound memory usage
+    workers = min(cpu_count(), len(paths))
+    if (
+        workers > 1
+        and sum(sizes) > _PARALLEL_LOAD_THRESHOLD
+        and max(sizes) <= _STREAMING_THRESHOLD
+    ):
+        return load_json_files(paths, cache)
 
-    return data
+    load = load_cached_json_file if cache else load_json_file
+    return chain.from_iterable(load(path) for path in paths)
 
 
-def filter_files(data: List[Any], regex: str) -> List[Any]:
-    return [d for d in data if not re.search(regex, d["file"], re.IGNORECASE)]
+def write_json_file(
+    data: Iterable[Any], json_file: BinaryIO, pretty: bool = False
+) -> int:
+    option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if pretty else 0
+    count = 0
+    json_file.write(b"[")
+    for entry in data:
+        if count:
+            json_file.write(b",")
+        json_file.write(b"\n")
+        json_file.write(orjson.dumps(entry, option=option))
+        count += 1
+    json_file.write(b"\n]")
+    return count
+
+
+def write_output(data: Iterable[Any], output: str, pretty: bool = False) -> int:
+    path = os.path.realpath(output)
+    exists = os.path.exists(path)
+
+    # The entries are only parsed while being written, they go to a temporary
+    # file that replaces the output once complete so that an error never
+    # leaves a truncated CDB behind
+    tmp_path = None
+    if not exists or os.path.isfile(path):
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=".compile_commands.", suffix=".json", dir=os.path.dirname(path)
+            )
+        except OSError:
+            # The output may be writable even though its directory isn't
+            if not exists:
+                raise
 
+    # Devices, pipes and outputs in read-only directories are written directly
+    if tmp_path is None:
+        with open(path, "wb", buffering=1 << 20) as json_file:
+            return write_json_file(data, json_file, pretty)
 
-def filter_commands(data: List[Any], regex: str, replacement: str) -> List[Any]:
+    try:
+        # Entries are serialized one at a time, the bigger buffer turns them
+        # into few large writes
+        with open(fd, "wb", buffering=1 << 20) as json_file:
+            count = write_json_file(data, json_file, pretty)
+
+        # mkstemp creates the file readable by its owner only, the output
+        # keeps its permissions when it is replaced
+        if exists:
+            shutil.copymode(path, tmp_path)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return count
+
+
+def add_flags(data: Iterable[Any], flags: str) -> Iterator[Any]:
+    parts = flags.split()
     for entry in data:
-        entry["command"] = re.sub(
-            regex, replacement, entry["command"], flags=re.IGNORECASE
-        )
-    return data
+        entry["arguments"].extend(parts)
+        yield entry
 
 
-def filter_include_directories(data: List[Any], regex: str) -> List[Any]:
+def change_compiler_path(data: Iterable[Any], new_path: str) -> Iterator[Any]:
+    prefix = os.path.normpath(new_path) + "/"
     for entry in data:
-        is_path = False
         arguments = entry["arguments"]
-        for index, arg in enumerate(arguments):
-            if arg in ("-I", "-isystem", "-iquote", "-idirafter"):
-                is_path = True
-            elif is_path:
-                is_path = False
-                if re.search(regex, arg) is not None:
-                    arguments[index] = ""
-                    arguments[index - 1] = ""
+        arguments[0] = move_compiler(arguments[0], prefix)
+        yield entry
 
-        entry["arguments"] = list(filter(None, arguments))
-    return data
+
+def to_clang(data: Iterable[Any]) -> Iterator[Any]:
+    for entry in data:
+        arguments = entry["arguments"]
+        arguments[0] = clang_compiler(arguments[0])
+        yield entry
 
 
-def to_command_cdb(data: List[Any]) -> List[Any]:
+def to_gcc(data: Iterable[Any]) -> Iterator[Any]:
     for entry in data:
-        if args := entry.get("arguments"):
-            entry["command"] = shlex.join(args)
-            del entry["arguments"]
-    return data
+        arguments = entry["arguments"]
+        arguments[0] = gcc_compiler(arguments[0])
+        yield entry
 
 
-def to_arguments_cdb(data: List[Any]) -> List[Any]:
+def normalize_include_directories(data: Iterable[Any]) -> Iterator[Any]:
     for entry in data:
-        if command := entry.get("command"):
-            if "'" in command or '"' in command:
-                entry["arguments"] = shlex.split(command)
-            else:
-                entry["arguments"] = command.split()
+        entry["arguments"] = transform_include_directories(
+            entry["arguments"], normalize=True
+        )
+        yield entry
 
-            del entry["command"]
-    return data
 
+def absolute_include_directories(data: Iterable[Any]) -> Iterator[Any]:
+    for entry in data:
+        entry["arguments"] = transform_include_directories(
+            entry["arguments"], entry["directory"], absolute=True
+        )
+        yield entry
 
-def split_includes(s: str, regex) -> List[str]:
-    if s.startswith(("-I", "-i")):
-        return regex.split(s)
-    return [s]
 
+def filter_files(data: Iterable[Any], pattern: Pattern) -> Iterator[Any]:
+    return select_files(data, pattern=pattern)
 
-def normalize(data: List[Any]) -> List[Any]:
-    data = to_arguments_cdb(data)
-    regex = re.compile("(-I)|(-iquote)|(-isystem)|(-idirafter)")
 
-    for entry in data:
-        arguments = [
-            x for arg in entry["arguments"] for x in split_includes(arg, regex)
-        ]
-        entry["arguments"] = list(filter(None, arguments))
+def is_literal(pattern: Pattern, replacement: str) -> bool:
+    literal = pattern.pattern
+    if _REGEX_METACHARACTERS.search(literal) or "\\" in replacement:
+        return False
 
-    return data
+    # str.replace is case sensitive, only fall back to it when casing can't matter
+    return not pattern.flags & regex.IGNORECASE or literal.lower() == literal.upper()
 
 
-def process_cdb(args, data: List[Any]) -> List[Any]:
-    if args.remove_files:
-        data = remove_files(
-            data, [args.path_prefix + x.strip() for x in args.remove_files]
+def filter_commands(
+    data: Iterable[Any], pattern: Pattern, replacement: str
+) -> Iterator[Any]:
+    literal = is_literal(pattern, replacement)
+    for entry in data:
+        entry["command"] = filter_command(
+            entry["command"], pattern, replacement, literal
         )
+        yield entry
+
 
-    if args.include_files:
-        data = include_files(
-            data, [args.path_prefix + x.strip() for x in args.include_files]
+def filter_include_directories(data: Iterable[Any], pattern: Pattern) -> Iterator[Any]:
+    for entry in data:
+        entry["arguments"] = transform_include_directories(
+            entry["arguments"], pattern=pattern
         )
+        yield entry
 
-    if args.filter_files:
-        data = filter_files(data, args.filter_files)
 
-    if args.filter:
-        data = to_command_cdb(data)
-        data = filter_commands(data, args.filter, args.replacement)
+def to_command_cdb(data: Iterable[Any]) -> Iterator[Any]:
+    return (to_command(entry) for entry in data)
 
-    data = normalize(data)
 
-    if args.add_flags:
-        data = add_flags(data, args.add_flags)
+def to_arguments_cdb(data: Iterable[Any]) -> Iterator[Any]:
+    return (to_arguments(entry) for entry in data)
 
-    if args.compiler_path:
-        data = change_compiler_path(data, args.compiler_path)
 
-    if args.clang:
-        data = to_clang(data)
-    elif args.gcc:
-        data = to_gcc(data)
+def normalize(data: Iterable[Any]) -> Iterator[Any]:
+    return (normalize_entry(entry) for entry in data)
 
-    if args.remove_duplicates:
-        s = {json.dumps(d, sort_keys=True) for d in data}
-        data = [json.loads(t) for t in s]
 
-    if args.filter_include_directories:
-        data = filter_include_directories(data, args.filter_include_directories)
+def use_normalized_cache(args) -> bool:
+    # --filter matches the commands as they were written, before the include
+    # directories are split from their flags
+    return bool(args.cache and not args.filter)
 
-    if args.absolute_include_directories:
-        data = absolute_include_directories(data)
 
-        if args.filter_include_directories:
-            data = filter_include_directories(data, args.filter_include_directories)
+def make_entry_transform(args) -> EntryTransform:
+    pattern = args.filter
 
-    if args.normalize_include_directories:
-        data = normalize_include_directories(data)
+    compiler: Optional[Callable[[str], str]] = None
+    if args.clang:
+        compiler = clang_compiler
+    elif args.gcc:
+        compiler = gcc_compiler
+
+    return EntryTransform(
+        filter=pattern,
+        replacement=args.replacement,
+        literal=pattern is not None and is_literal(pattern, args.replacement),
+        flags=args.add_flags.split() if args.add_flags else [],
+        compiler_prefix=(
+            os.path.normpath(args.compiler_path) + "/" if args.compiler_path else None
+        ),
+        compiler=compiler,
+        include_directories_pattern=args.filter_include_directories,
+        absolute_include_directories=args.absolute_include_directories,
+        normalize_include_directories=args.normalize_include_directories,
+        command=args.command,
+        normalized=use_normalized_cache(args),
+    )
 
-    if args.command:
-        data = to_command_cdb(data)
 
-    return data
+def transform_cdb(transform: EntryTransform, data: Iterable[Any]) -> Iterator[Any]:
+    data = iter(data)
+    first = list(islice(data, _CHUNK_SIZE))
+
+    # Small CDBs aren't worth the cost of sending entries to other processes
+    workers = cpu_count()
+    if len(first) < _CHUNK_SIZE or workers == 1:
+        yield from (transform_entry(transform, entry) for entry in chain(first, data))
+        return
+
+    chunks = chain([first], iter(lambda: list(islice(data, _CHUNK_SIZE)), []))
+    executor = get_executor(workers)
+
+    # Bounds the number of chunks in flight so that the CDB is still streamed
+    pending: Deque[Future] = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(transform_chunk, transform, chunk))
+        if len(pending) > 2 * workers:
+            yield from pending.popleft().result()
+
+    while pending:
+        yield from pending.popleft().result()
+
+
+def process_cdb(args, data: Iterable[Any]) -> Iterable[Any]:
+    if args.remove_files or args.include_files or args.filter_files:
+        data = select_files(
+            data,
+            removed=(
+                [args.path_prefix + x.strip() for x in args.remove_files]
+                if args.remove_files
+                else None
+            ),
+            included=(
+                [args.path_prefix + x.strip() for x in args.include_files]
+                if args.include_files
+                else None
+            ),
+            pattern=args.filter_files,
+        )
+
+    transform = make_entry_transform(args)
+    if args.remove_duplicates:
+        # Duplicates are found before the include directories and the command
+        # are changed, those options then run on the remaining entries
+        data = remove_duplicates(
+            transform_cdb(
+                transform._replace(
+                    include_directories_pattern=None,
+                    absolute_include_directories=False,
+                    normalize_include_directories=False,
+                    command=False,
+                ),
+                data,
+            )
+        )
+        if not transform.include_directories and not transform.command:
+            return data
+        transform = transform._replace(
+            filter=None, flags=[], compiler_prefix=None, compiler=None, normalized=True
+        )
+
+    return transform_cdb(transform, data)
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -503,12 +836,16 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
         args.file = os.path.abspath(args.file)
         args.dir = os.path.dirname(args.file)
     else:
-        args.dir = os.path.normpath(os.path.abspath(args.dir))
+        args.dir = os.path.normpath(os.path.abspath(args.dir or os.curdir))
 
-    data: List[Any] = []
+    normalized = use_normalized_cache(args)
+    data: Iterable[Any] = []
     if args.merge or args.files:
         if not args.files:
-            cdbs = get_compile_dbs(args.dir)
+            if args.cache:
+                cdbs = get_cached_compile_dbs(args.dir)
+            else:
+                cdbs = get_compile_dbs(args.dir)
             if not cdbs:
                 print(
                     f"error: no compilation databases found in {args.dir}",
@@ -520,10 +857,10 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
                 print("-- Found the following compilation databases: ")
                 pprint(cdbs)
                 print("")
-            data = merge_json_files(cdbs)
+            data = merge_json_files(cdbs, normalized)
         else:
             try:
-                data = merge_json_files(args.files)
+                data = merge_json_files(args.files, normalized)
             except FileNotFoundError as e:
                 print(
                     f"error: one of the file passed to --files couldn't be opened.",
@@ -534,52 +871,67 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     else:
         filepath = args.file if args.file else f"{args.dir}/compile_commands.json"
         try:
-            with open(filepath, "r") as json_file:
-                data = json.load(json_file)
+            data = merge_json_files([filepath], normalized)
         except FileNotFoundError:
             print(f"error: {filepath} not found.", file=sys.stderr)
             return 2
 
+    # The working directory is only looked up when it is actually needed
     if not args.output:
-        args.output = f"{args.dir}/compile_commands.json"
+        args.output = os.path.join(os.getcwd(), "compile_commands.json")
 
     data = process_cdb(args, data)
 
+    try:
+        if args.run:
+            # The commands are needed again once the output has been written
+            data = list(data)
+
+        sink = args.output.lower()
+        if sink == "none":
+            count = sum(1 for _ in data)
+        elif sink in ("stdout", "stderr"):
+            stream = sys.stdout if sink == "stdout" else sys.stderr
+            stream.flush()
+            if hasattr(stream, "buffer"):
+                count = write_json_file(data, stream.buffer, args.pretty)
+                stream.buffer.write(b"\n")
+                stream.buffer.flush()
+            else:
+                # Text streams such as the io.StringIO of redirect_stdout have
+                # no underlying binary buffer
+                output = io.BytesIO()
+                count = write_json_file(data, output, args.pretty)
+                stream.write(output.getvalue().decode() + "\n")
+        else:
+            entries = iter(data)
+            first = next(entries, None)
+            if first is None:
+                print("error: The output compilation database has no commands.")
+                return 1
+
+            if args.verbose:
+                print(f"-- writing to {args.output}")
+            count = write_output(chain([first], entries), args.output, args.pretty)
+    except CDBParseError as e:
+        print(f"error: couldn't parse json file {e}", file=sys.stderr)
+        return 1
+
     if args.verbose:
         end = time.time()
 
         print(
             "-- {} commands processed in {}s.".format(
-                len(data),
+                count,
                 round(end - start, 4),
             )
         )
 
-    create_file = not any(
-        [
-            args.output.lower() == "stdout",
-            args.output.lower() == "stderr",
-            args.output.lower() == "none",
-        ]
-    )
-
-    if create_file:
-        if data:
-            if args.verbose:
-                print(f"-- writing to {args.output}")
-            with open(str(args.output), "w") as json_file:
-                json.dump(data, json_file, indent=4, sort_keys=True)
-        else:
-            print("error: The output compilation database has no commands.")
-            return 1
-    else:
-        if args.output == "stdout":
-            print(json.dumps(data, indent=4, sort_keys=False))
-        elif args.output == "stderr":
-            print(json.dumps(data, indent=4, sort_keys=False), file=sys.stderr)
-
     if args.run:
-        data = normalize(data)
+        data = list(normalize(data))
+        # asyncio is only imported when the commands are actually run
+        from .execution import execute
+
         execute(data, args.threads, args.verbose)
 
     return 0
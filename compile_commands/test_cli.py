@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+from contextlib import redirect_stderr, redirect_stdout
 from pathlib import Path
-from .main import main
+from .main import main, _CHUNK_SIZE
 import pytest
+import io
 import json
+import os
 
 
 @pytest.fixture
@@ -33,6 +36,27 @@ def test_exclusive_commands(capsys, arg1, arg2):
     )
 
 
+def test_version(capsys):
+    with pytest.raises(SystemExit):
+        main(["--version"])
+
+    out, err = capsys.readouterr()
+    assert out.startswith("pytest ")
+    assert not err
+
+
+@pytest.mark.parametrize(
+    "arg", ["--filter", "--filter_files", "--filter_include_directories"]
+)
+def test_invalid_pattern(capsys, current_path, arg):
+    with pytest.raises(SystemExit):
+        main(["--file", str(current_path / "data/data.json"), arg, "("])
+
+    out, err = capsys.readouterr()
+    assert not out
+    assert f"pytest: error: argument {arg}: invalid regular expression '('" in err
+
+
 def test_no_files(capsys, current_path):
     f = current_path / "does_not_exist.json"
     main(["--file", str(f)])
@@ -60,6 +84,120 @@ def test_execution(capfd, current_path):
     assert "hello1" in out
 
 
+def test_execution_failure(capfd, tmp_path):
+    cdb = tmp_path / "compile_commands.json"
+    cdb.write_text(
+        json.dumps(
+            [
+                {
+                    "directory": str(tmp_path),
+                    "command": "sh -c 'echo failure; exit 3'",
+                    "file": "file.c",
+                },
+                {
+                    "directory": str(tmp_path),
+                    "command": "does_not_exist file.c",
+                    "file": "file.c",
+                },
+            ]
+        )
+    )
+
+    assert main(["--file", str(cdb), "--run", "-o", "none"]) == 0
+
+    out, err = capfd.readouterr()
+    assert not err
+    assert "1 of 2 failed with return code 3\nfailure" in out
+    assert "2 of 2 failed: [Errno 2]" in out
+
+
+@pytest.mark.parametrize("output", ["none", "stdout", "output.json"])
+def test_invalid_json(capsys, monkeypatch, tmp_path, output):
+    monkeypatch.chdir(tmp_path)
+    cdb = tmp_path / "compile_commands.json"
+    cdb.write_text('[{"directory": "/", "command": "cc file.c",')
+
+    assert main(["--file", str(cdb), "-o", output]) == 1
+
+    out, err = capsys.readouterr()
+    assert err.startswith(f"error: couldn't parse json file {cdb}: ")
+
+
+def test_invalid_json_output(capsys, tmp_path):
+    # Enough entries before the invalid file for the output to be written to
+    entries = [
+        {"directory": str(tmp_path), "command": f"cc a{i}.c", "file": f"a{i}.c"}
+        for i in range(_CHUNK_SIZE + 1)
+    ]
+    valid = tmp_path / "valid.json"
+    valid.write_text(json.dumps(entries))
+    invalid = tmp_path / "invalid.json"
+    invalid.write_text('[{"directory": "/", "command": "cc file.c",')
+    output = tmp_path / "output.json"
+    output.write_text("[]")
+
+    assert main(["--files", str(valid), str(invalid), "-o", str(output)]) == 1
+
+    capsys.readouterr()
+    assert output.read_text() == "[]"
+    assert sorted(os.listdir(tmp_path)) == ["invalid.json", "output.json", "valid.json"]
+
+
+@pytest.mark.parametrize("mode", [None, 0o600, 0o640])
+def test_output_permissions(tmp_path, current_path, mode):
+    output = tmp_path / "output.json"
+    if mode is None:
+        umask = os.umask(0)
+        os.umask(umask)
+        expected = 0o666 & ~umask
+    else:
+        output.write_text("[]")
+        output.chmod(mode)
+        expected = mode
+
+    assert (
+        main(["--file", str(current_path / "data/data.json"), "-o", str(output)]) == 0
+    )
+    assert output.stat().st_mode & 0o777 == expected
+    assert len(json.loads(output.read_text())) == 5
+
+
+def test_output_read_only_directory(monkeypatch, tmp_path, current_path):
+    output = tmp_path / "output.json"
+    output.write_text("[]")
+
+    def mkstemp(*args, **kwargs):
+        raise PermissionError(13, "Permission denied", str(tmp_path))
+
+    monkeypatch.setattr("tempfile.mkstemp", mkstemp)
+    assert (
+        main(["--file", str(current_path / "data/data.json"), "-o", str(output)]) == 0
+    )
+    assert len(json.loads(output.read_text())) == 5
+
+
+@pytest.mark.parametrize("threads", ["0", "-1"])
+def test_invalid_threads(capsys, current_path, threads):
+    with pytest.raises(SystemExit):
+        main(["--file", str(current_path / "data/data.json"), "--run", f"-j{threads}"])
+
+    out, err = capsys.readouterr()
+    assert not out
+    assert err.endswith(
+        f"pytest: error: argument -j/--threads: must be at least 1, got {threads}\n"
+    )
+
+
+@pytest.mark.parametrize("sink", ["stdout", "stderr"])
+def test_text_stream_output(current_path, sink):
+    stream = io.StringIO()
+    redirect = redirect_stdout if sink == "stdout" else redirect_stderr
+    with redirect(stream):
+        main(["--file", str(current_path / "data/data.json"), "-o", sink])
+
+    assert len(json.loads(stream.getvalue())) == 5
+
+
 def test_warnings(capsys, current_path):
     f1 = str(current_path / "data/data.json")
     f2 = f1
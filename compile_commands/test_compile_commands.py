@@ -1,30 +1,54 @@
 from pathlib import Path
 from .main import *
+from .transform import *
 
 import pytest
 import json
+import orjson
+import regex
+import io
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def current_path() -> Path:
     return Path(__file__).parent.resolve()
 
 
+@pytest.fixture(scope="session")
+def cdb_bytes(current_path: Path) -> bytes:
+    return (current_path / "data/data.json").read_bytes()
+
+
+@pytest.fixture(scope="session")
+def arguments_cdb_bytes(current_path: Path) -> bytes:
+    return (current_path / "data/arguments_cdb.json").read_bytes()
+
+
+@pytest.fixture(scope="session")
+def compile_dbs_dir(current_path: Path) -> str:
+    return str(current_path / "data/compile_commands_tests")
+
+
+@pytest.fixture(scope="session")
+def compile_dbs(compile_dbs_dir: str) -> List[str]:
+    return get_compile_dbs(compile_dbs_dir)
+
+
+# The files are read once, parsing them again gives each test entries it can
+# modify in place
 @pytest.fixture
-def cdb(current_path: Path):
-    with open(current_path / "data/data.json", "r") as f:
-        return json.load(f)
+def cdb(cdb_bytes: bytes):
+    return orjson.loads(cdb_bytes)
 
 
 @pytest.fixture
-def arguments_cdb(current_path: Path):
-    with open(current_path / "data/arguments_cdb.json", "r") as f:
-        return json.load(f)
+def arguments_cdb(arguments_cdb_bytes: bytes):
+    return orjson.loads(arguments_cdb_bytes)
 
 
 @pytest.fixture
 def normalized_cdb(cdb):
-    return normalize(cdb)
+    return list(normalize(cdb))
 
 
 @pytest.mark.parametrize(
@@ -36,7 +60,7 @@ def normalized_cdb(cdb):
     ],
 )
 def test_remove_files(cdb, file, count):
-    assert len(remove_files(cdb, file)) == count
+    assert len(list(remove_files(cdb, file))) == count
 
 
 @pytest.mark.parametrize(
@@ -48,11 +72,11 @@ def test_remove_files(cdb, file, count):
     ],
 )
 def test_include_files(cdb, file, count):
-    assert len(include_files(cdb, file)) == count
+    assert len(list(include_files(cdb, file))) == count
 
 
 @pytest.mark.parametrize(
-    "regex,index,expected_args_len",
+    "pattern,index,expected_args_len",
     [
         ("\\.", 0, 4),
         ("\\.", 1, 4),
@@ -61,8 +85,8 @@ def test_include_files(cdb, file, count):
         ("path/to/", 3, 4),
     ],
 )
-def test_filter_include_directories(normalized_cdb, regex, index, expected_args_len):
-    data = filter_include_directories(normalized_cdb, regex)
+def test_filter_include_directories(normalized_cdb, pattern, index, expected_args_len):
+    data = list(filter_include_directories(normalized_cdb, regex.compile(pattern)))
     assert len(data[index]["arguments"]) == expected_args_len
 
 
@@ -76,13 +100,59 @@ def test_filter_include_directories(normalized_cdb, regex, index, expected_args_
     ],
 )
 def test_absolute_include_directories(normalized_cdb, index, flag, dir):
-    data = absolute_include_directories(normalized_cdb)
+    data = list(absolute_include_directories(normalized_cdb))
     assert data[index]["arguments"][-1] == dir
     assert data[index]["arguments"][-2] == flag
 
 
+@pytest.mark.parametrize(
+    "path",
+    [
+        "",
+        ".",
+        "..",
+        "/",
+        "//",
+        "///usr",
+        "/usr/include",
+        "/usr/include/",
+        "/usr/./include",
+        "/usr/../include",
+        "/usr/include/..",
+        "../include",
+        "./include",
+        "include/.hidden",
+        "include//dir",
+        "in.clude/file.h",
+    ],
+)
+def test_normalize_path(path):
+    assert normalize_path(path) == os.path.normpath(path)
+
+
+@pytest.mark.parametrize(
+    "directory,path,expected",
+    [
+        ("/build", "include", "/build/include"),
+        ("/build/", "../include", "/include"),
+        ("/build", "./include/", "/build/include"),
+        ("", "include/../src", "src"),
+        ("/", "include", "/include"),
+        ("/", "../x", "/x"),
+    ],
+)
+def test_absolute_path(directory, path, expected):
+    absolute_path.cache_clear()
+    assert absolute_path(directory, path) == expected
+    assert absolute_path.cache_info().misses == 1
+
+    # The same pair is only joined and normalized once
+    assert absolute_path(directory, path) == expected
+    assert absolute_path.cache_info().hits == 1
+
+
 def test_normalize_include_directories(normalized_cdb):
-    data = normalize_include_directories(normalized_cdb)
+    data = list(normalize_include_directories(normalized_cdb))
     assert data[4]["arguments"] == [
         "/usr/bin/clang",
         "-isystem",
@@ -106,27 +176,59 @@ def test_normalize_include_directories(normalized_cdb):
     ],
 )
 def test_compiler(normalized_cdb, index, clang, gcc):
-    data = to_clang(normalized_cdb)
+    data = list(to_clang(normalized_cdb))
     assert data[index]["arguments"][0] == clang
-    data = to_gcc(normalized_cdb)
+    data = list(to_gcc(normalized_cdb))
     assert data[index]["arguments"][0] == gcc
 
 
 @pytest.mark.parametrize(
-    "regex,length",
+    "compiler,clang,gcc",
+    [
+        ("gcc", "clang", "gcc"),
+        ("/usr/bin/g++-11", "/usr/bin/clang++-11", "/usr/bin/g++-11"),
+        ("/opt/gcc/bin/gcc", "/opt/gcc/bin/clang", "/opt/gcc/bin/gcc"),
+        ("/opt/clang/bin/g++", "/opt/clang/bin/clang++", "/opt/clang/bin/g++"),
+        ("/usr/bin/cc", "/usr/bin/cc", "/usr/bin/cc"),
+    ],
+)
+def test_substitute_compiler(compiler, clang, gcc):
+    assert clang_compiler(compiler) == clang
+    assert gcc_compiler(clang_compiler(compiler)) == gcc
+
+
+@pytest.mark.parametrize(
+    "pattern,length",
     [
         ("file", 0),
         ("\\.cpp$", 3),
         ("\\.c$", 2),
     ],
 )
-def test_filter_files(cdb, regex, length):
-    assert len(filter_files(cdb, regex)) == length
+def test_filter_files(cdb, pattern, length):
+    assert (
+        len(list(filter_files(cdb, regex.compile(pattern, regex.IGNORECASE)))) == length
+    )
+
 
+def test_select_files(cdb, cdb_bytes):
+    removed = ["path/to/file1.c"]
+    included = ["path/to/file1.c", "path/to/file2.cpp", "path/to/file4.c"]
+    pattern = regex.compile("\\.cpp$", regex.IGNORECASE)
+
+    expected = list(
+        filter_files(
+            include_files(remove_files(orjson.loads(cdb_bytes), removed), included),
+            pattern,
+        )
+    )
+    assert list(select_files(cdb, removed, included, pattern)) == expected
+    assert [entry["file"] for entry in expected] == ["path/to/file4.c"]
 
-def test_get_compile_dbs(current_path: Path):
-    p = str(current_path / "data/compile_commands_tests")
-    assert set(get_compile_dbs(p)) == set(
+
+def test_get_compile_dbs(compile_dbs_dir: str, compile_dbs: List[str]):
+    p = compile_dbs_dir
+    assert set(compile_dbs) == set(
         [
             os.path.join(p, "component1/compile_commands.json"),
             os.path.join(p, "component2/compile_commands.json"),
@@ -137,13 +239,230 @@ def test_get_compile_dbs(current_path: Path):
     )
 
 
-def test_merge_json_files(current_path: Path):
-    p = str(current_path / "data/compile_commands_tests")
-    assert len(merge_json_files(get_compile_dbs(p))) == 6
+@pytest.mark.parametrize(
+    "flags",
+    [
+        [],
+        ["--clang", "--add_flags=-O3 -I include", "--command"],
+        ["--gcc", "--compiler_path=/usr/bin", "--normalize_include_directories"],
+        ["--absolute_include_directories", "--filter_include_directories=build$"],
+        ["--filter=path/to/", "--replacement=src/", "--absolute_include_directories"],
+    ],
+)
+def test_transform_entry(current_path, cdb, cdb_bytes, flags):
+    args = parse_arguments(["--file", str(current_path / "data/data.json"), *flags])
+    transform = make_entry_transform(args)
+
+    data = orjson.loads(cdb_bytes)
+    if transform.filter:
+        data = filter_commands(to_command_cdb(data), transform.filter, args.replacement)
+    data = add_flags(normalize(data), args.add_flags or "")
+    if args.compiler_path:
+        data = change_compiler_path(data, args.compiler_path)
+    if args.clang:
+        data = to_clang(data)
+    elif args.gcc:
+        data = to_gcc(data)
+    if transform.include_directories_pattern:
+        data = filter_include_directories(data, transform.include_directories_pattern)
+    if args.absolute_include_directories:
+        data = absolute_include_directories(data)
+        if transform.include_directories_pattern:
+            data = filter_include_directories(
+                data, transform.include_directories_pattern
+            )
+    if args.normalize_include_directories:
+        data = normalize_include_directories(data)
+    if args.command:
+        data = to_command_cdb(data)
+
+    assert [transform_entry(transform, entry) for entry in cdb] == list(data)
+
+
+@pytest.mark.parametrize("chunk_size,workers", [(4096, 4), (2, 1), (2, 4)])
+def test_transform_cdb(monkeypatch, current_path, cdb, cdb_bytes, chunk_size, workers):
+    args = parse_arguments(
+        ["--file", str(current_path / "data/data.json"), "--clang", "--command"]
+    )
+    transform = make_entry_transform(args)
+    expected = [transform_entry(transform, entry) for entry in orjson.loads(cdb_bytes)]
+
+    monkeypatch.setattr("compile_commands.main._CHUNK_SIZE", chunk_size)
+    monkeypatch.setattr("compile_commands.main.cpu_count", lambda: workers)
+    assert list(transform_cdb(transform, cdb)) == expected
+
+
+def test_remove_duplicates(normalized_cdb):
+    data = list(remove_duplicates(normalized_cdb + normalized_cdb[::-1]))
+    assert data == normalized_cdb
+
+
+def test_remove_duplicates_fields():
+    entry = {"directory": "/build", "file": "a.c", "arguments": ["cc", "a.c"]}
+    data = [
+        entry,
+        dict(reversed(entry.items())),
+        {**entry, "output": "a.o"},
+        {**entry, "extra": {"flags": ["-O2"]}},
+        {**entry, "extra": {"flags": ["-O3"]}},
+    ]
+
+    # Entries differing in any field are kept, the order of the fields doesn't matter
+    assert list(remove_duplicates(data)) == [data[0], *data[2:]]
+
+
+@pytest.mark.parametrize(
+    "flags,count",
+    [
+        ([], 2),
+        (["--filter_include_directories=gen"], 2),
+        (["--add_flags=-Igen", "--absolute_include_directories", "--command"], 2),
+        (["--filter=-Igen"], 1),
+    ],
+)
+def test_process_cdb_remove_duplicates(current_path, flags, count):
+    args = parse_arguments(
+        ["--file", str(current_path / "data/data.json"), "--remove_duplicates", *flags]
+    )
+    data = [
+        {"directory": "/build", "command": "cc -Iinclude a.c", "file": "a.c"},
+        {"directory": "/build", "command": "cc -Iinclude -Igen a.c", "file": "a.c"},
+        {"directory": "/build", "command": "cc -Iinclude a.c", "file": "a.c"},
+    ]
+
+    # Duplicates are removed before the include directories are changed
+    assert len(list(process_cdb(args, data))) == count
+
+
+@pytest.mark.parametrize(
+    "mmap_threshold,streaming_threshold",
+    [
+        (1 << 20, 1 << 20),
+        (0, 1 << 20),
+        (0, 0),
+    ],
+)
+def test_load_json_file(
+    monkeypatch, current_path, cdb, mmap_threshold, streaming_threshold
+):
+    monkeypatch.setattr("compile_commands.main._MMAP_THRESHOLD", mmap_threshold)
+    monkeypatch.setattr(
+        "compile_commands.main._STREAMING_THRESHOLD", streaming_threshold
+    )
+    assert list(load_json_file(str(current_path / "data/data.json"))) == cdb
+
+
+def test_get_compile_dbs_walk(tmp_path: Path):
+    for d in ("root", "root/a", "root/.hidden"):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / "compile_commands.json").write_text("[]")
+    (tmp_path / "root/a/loop").symlink_to(tmp_path / "root")
+
+    assert get_compile_dbs(str(tmp_path / "root")) == [
+        str(tmp_path / "root/a/compile_commands.json")
+    ]
+
+
+def test_get_compile_dbs_unreadable(monkeypatch, tmp_path: Path):
+    for d in ("root/a", "root/b/c"):
+        (tmp_path / d).mkdir(parents=True)
+        (tmp_path / d / "compile_commands.json").write_text("[]")
+
+    scandir = os.scandir
+    unreadable = str(tmp_path / "root/b")
+
+    def unreadable_scandir(path):
+        if path == unreadable:
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", unreadable_scandir)
+    directories: Dict[str, int] = {}
+    assert get_compile_dbs(str(tmp_path / "root"), directories) == [
+        str(tmp_path / "root/a/compile_commands.json")
+    ]
+    assert sorted(directories) == [str(tmp_path / "root"), str(tmp_path / "root/a")]
+
+
+def test_get_cached_compile_dbs(monkeypatch, tmp_path: Path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    root = tmp_path / "root"
+    (root / "a").mkdir(parents=True)
+    (root / "a/compile_commands.json").write_text("[]")
+
+    expected = [str(root / "a/compile_commands.json")]
+    assert get_cached_compile_dbs(str(root)) == expected
+    assert os.path.exists(get_cache_path(str(root)))
+    assert get_cached_compile_dbs(str(root)) == expected
+
+    (root / "b").mkdir()
+    (root / "b/compile_commands.json").write_text("[]")
+    expected.append(str(root / "b/compile_commands.json"))
+    assert sorted(get_cached_compile_dbs(str(root))) == expected
+
+
+def test_load_cached_json_file(monkeypatch, tmp_path: Path, cdb, normalized_cdb):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    path = tmp_path / "compile_commands.json"
+    path.write_bytes(orjson.dumps(cdb))
+
+    cache_path = get_cache_path(str(path), ".pickle")
+    assert list(load_cached_json_file(str(path))) == normalized_cdb
+    assert os.path.exists(cache_path)
+    assert list(load_cached_json_file(str(path))) == normalized_cdb
+
+    path.write_bytes(orjson.dumps(cdb[:2]))
+    assert list(load_cached_json_file(str(path))) == normalized_cdb[:2]
+
+
+def test_transform_entry_normalized(current_path, cdb_bytes, normalized_cdb):
+    args = parse_arguments(
+        ["--file", str(current_path / "data/data.json"), "--cache", "--clang"]
+    )
+    expected = [
+        transform_entry(make_entry_transform(args)._replace(normalized=False), entry)
+        for entry in orjson.loads(cdb_bytes)
+    ]
+
+    transform = make_entry_transform(args)
+    assert transform.normalized
+    assert [transform_entry(transform, entry) for entry in normalized_cdb] == expected
+
+
+@pytest.mark.parametrize("pattern", ["-o [^ ]*", "-I\\.\\.", "-Isome\\w+"])
+def test_cache_filter(monkeypatch, capsys, tmp_path, current_path, pattern):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    argv = [
+        "--file",
+        str(current_path / "data/data.json"),
+        f"--filter={pattern}",
+        "--output=stdout",
+    ]
+
+    main(argv)
+    expected = capsys.readouterr().out
+
+    # The normalized entries kept by --cache have their include directories
+    # split from their flags, the filter must still see the original commands
+    for _ in range(2):
+        main([*argv, "--cache"])
+        assert capsys.readouterr().out == expected
+
+
+def test_merge_json_files(compile_dbs: List[str]):
+    assert len(list(merge_json_files(compile_dbs))) == 6
+
+
+def test_merge_json_files_parallel(monkeypatch, compile_dbs: List[str]):
+    expected = list(merge_json_files(compile_dbs))
+
+    monkeypatch.setattr("compile_commands.main._PARALLEL_LOAD_THRESHOLD", 0)
+    monkeypatch.setattr("compile_commands.main.cpu_count", lambda: 2)
+    assert list(merge_json_files(compile_dbs)) == expected
 
 
 def test_filter_commands(cdb):
-    data = filter_commands(cdb, "-o .*\\.o", "")
+    data = list(filter_commands(cdb, regex.compile("-o .*\\.o", regex.IGNORECASE), ""))
 
     for entry in data:
         assert "-o" not in entry["command"] and "output" not in entry["command"]
@@ -151,6 +470,75 @@ def test_filter_commands(cdb):
         assert "-o" not in entry["command"] and "output" not in entry["command"]
 
 
+@pytest.mark.parametrize(
+    "pattern,replacement,literal",
+    [
+        (" -", "", True),
+        ("path/to/", "other/", False),
+        ("-o .*\\.o", "", False),
+        ("(-I)", "\\1", False),
+    ],
+)
+def test_is_literal(pattern, replacement, literal):
+    assert is_literal(regex.compile(pattern, regex.IGNORECASE), replacement) == literal
+
+
+def test_filter_commands_literal(cdb):
+    data = list(filter_commands(cdb, regex.compile("/", regex.IGNORECASE), ""))
+
+    for entry in data:
+        assert "/" not in entry["command"]
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["gcc", "-c", "file.c", "-DFOO=1", "-I/usr/include"],
+        ["gcc", "-DFOO=a b"],
+        ["gcc", "", "file.c"],
+        ["gcc", "-DFOO='a'", '-DBAR=\\"b\\"'],
+        ["gcc", "-DFOO=$(BAR)", "a;b", "*.c"],
+        ["gcc", "-DFOO=é"],
+    ],
+)
+def test_join_split_arguments(args):
+    command = join_arguments(args)
+    assert command == shlex.join(args)
+    assert split_command(command) == args
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        "gcc -DFOO=\"a b\" -DBAR='c d' file.c",
+        'gcc -DFOO="a \\"b\\" \\$c \\d" a\\ b',
+        'gcc \'\'"" ""x',
+        "gcc -DFOO='a",
+        'gcc -DFOO="a',
+        "gcc 'a' b\\",
+    ],
+)
+def test_split_command(command):
+    try:
+        expected = shlex.split(command)
+    except ValueError:
+        with pytest.raises(ValueError):
+            split_command(command)
+    else:
+        assert split_command(command) == expected
+
+
+@pytest.mark.parametrize(
+    "command,arguments",
+    [
+        ("cc -DX=a\\ b.c \\", ["cc", "-DX=a\\", "b.c", "\\"]),
+        ("cc -I..\\include a.c", ["cc", "-I..\\include", "a.c"]),
+    ],
+)
+def test_split_command_unquoted(command, arguments):
+    assert split_command(command) == arguments
+
+
 @pytest.mark.parametrize(
     "index,result",
     [
@@ -159,7 +547,7 @@ def test_filter_commands(cdb):
     ],
 )
 def test_command_cdb(arguments_cdb, index, result):
-    data = to_command_cdb(arguments_cdb)
+    data = list(to_command_cdb(arguments_cdb))
 
     assert "arguments" not in data[index].keys()
     assert data[index]["command"] == result
@@ -204,20 +592,50 @@ def test_command_cdb(arguments_cdb, index, result):
     ],
 )
 def test_arguments_cdb(cdb, index, result):
-    data = to_arguments_cdb(cdb)
+    data = list(to_arguments_cdb(cdb))
 
     assert "command" not in data[index].keys()
     assert data[index]["arguments"] == result
 
 
+@pytest.mark.parametrize(
+    "arg,result",
+    [
+        ("-I/usr/include", ["-I", "/usr/include"]),
+        ("-I", ["-I"]),
+        ("-isystem..", ["-isystem", ".."]),
+        ("-iquote", ["-iquote"]),
+        ("-isysroot/sdk", ["-isysroot/sdk"]),
+        ("-Ia-Ib", ["-I", "a-Ib"]),
+        ("-c", ["-c"]),
+    ],
+)
+def test_split_includes(arg, result):
+    assert split_includes(arg) == result
+
+
+def test_normalize_interning(normalized_cdb):
+    first, second = normalized_cdb[0], normalized_cdb[1]
+    assert first["directory"] is second["directory"]
+    assert first["arguments"][2] is second["arguments"][2]
+
+
 def test_change_compiler_path(normalized_cdb):
-    data = change_compiler_path(normalized_cdb, "/usr/local/bin/")
+    data = list(change_compiler_path(normalized_cdb, "/usr/local/bin/"))
     for entry in data:
         assert entry["arguments"][0].startswith("/usr/local/bin/")
 
 
 def test_add_flags(normalized_cdb):
-    data = add_flags(normalized_cdb, "-flag -O3")
+    data = list(add_flags(normalized_cdb, "-flag -O3"))
     for entry in data:
         assert "-flag" in entry["arguments"]
         assert "-O3" in entry["arguments"]
+
+
+@pytest.mark.parametrize("pretty", [False, True])
+def test_write_json_file(normalized_cdb, pretty):
+    buffer = io.BytesIO()
+    assert write_json_file(normalized_cdb, buffer, pretty) == len(normalized_cdb)
+    assert json.loads(buffer.getvalue()) == normalized_cdb
+    assert (b"\n  " in buffer.getvalue()) == pretty
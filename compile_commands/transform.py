@@ -0,0 +1,273 @@
+from typing import (
+    Any,
+    Callable,
+    List,
+    Match,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from functools import lru_cache
+from regex import Pattern
+
+import os
+import re
+import shlex
+import sys
+
+_INCLUDE_FLAGS = frozenset(("-I", "-isystem", "-iquote", "-idirafter"))
+_INCLUDE_PREFIXES = ("-I", "-isystem", "-iquote", "-idirafter")
+_CLANG_SUBSTITUTIONS = (("g++", "clang++"), ("gcc", "clang"))
+_GCC_SUBSTITUTIONS = (("clang++", "g++"), ("clang", "gcc"))
+_SHELL_UNSAFE = re.compile(r"[^\w@%+=:,./ -]", re.ASCII)
+# Words as split by shlex in POSIX mode, anything else is a stray quote or
+# escape that shlex reports as an error
+_SHELL_WORD = re.compile(
+    r"""((?:[^ \t\r\n'"\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")+)|([^ \t\r\n])""", re.S
+)
+_SHELL_QUOTING = re.compile(r"""\\(.)|'([^']*)'|"((?:[^"\\]|\\.)*)\"""", re.S)
+_DOUBLE_QUOTED_ESCAPE = re.compile(r'\\([\\"])')
+
+
+def substitute_compiler(compiler: str, substitutions: Sequence[Tuple[str, str]]) -> str:
+    # Only the executable name is looked at, a directory named after a
+    # compiler is left untouched while version suffixes (gcc-11) are kept
+    directory, sep, name = compiler.rpartition("/")
+    for old, new in substitutions:
+        if name.startswith(old):
+            return directory + sep + new + name[len(old) :]
+    return compiler
+
+
+# A CDB only uses a handful of compilers, each is rewritten once
+@lru_cache(maxsize=None)
+def clang_compiler(compiler: str) -> str:
+    return substitute_compiler(compiler, _CLANG_SUBSTITUTIONS)
+
+
+@lru_cache(maxsize=None)
+def gcc_compiler(compiler: str) -> str:
+    return substitute_compiler(compiler, _GCC_SUBSTITUTIONS)
+
+
+@lru_cache(maxsize=None)
+def move_compiler(compiler: str, prefix: str) -> str:
+    return prefix + compiler.rpartition("/")[2]
+
+
+def normalize_path(path: str) -> str:
+    # Most paths found in a CDB are already normalized, only the ones with
+    # empty, "." or ".." components or a trailing slash go through normpath
+    if (
+        not path
+        or path.startswith(".")
+        or path.endswith("/")
+        or "/." in path
+        or "//" in path
+    ):
+        return os.path.normpath(path)
+    return path
+
+
+# Entries compiled from the same directory share their relative include
+# directories, each pair is only joined and normalized once
+@lru_cache(maxsize=None)
+def absolute_path(directory: str, path: str) -> str:
+    return normalize_path(os.path.join(directory, path))
+
+
+def transform_include_directories(
+    arguments: List[str],
+    directory: str = "",
+    pattern: Optional[Pattern] = None,
+    absolute: bool = False,
+    normalize: bool = False,
+) -> List[str]:
+    result: List[str] = []
+    is_path = False
+    for arg in arguments:
+        if arg in _INCLUDE_FLAGS:
+            is_path = True
+        elif is_path:
+            is_path = False
+
+            # Dropping the include directory along with its flag
+            if pattern and pattern.search(arg):
+                result.pop()
+                continue
+
+            if absolute and not arg.startswith("/"):
+                arg = absolute_path(directory, arg)
+                if pattern and pattern.search(arg):
+                    result.pop()
+                    continue
+
+            if normalize:
+                arg = normalize_path(arg)
+
+        result.append(arg)
+
+    # The compiler path is normalized as well
+    if normalize and result and result[0] not in _INCLUDE_FLAGS:
+        result[0] = normalize_path(result[0])
+
+    return result
+
+
+def filter_command(
+    command: str, pattern: Pattern, replacement: str, literal: bool
+) -> str:
+    if literal:
+        return command.replace(pattern.pattern, replacement)
+    return pattern.sub(replacement, command)
+
+
+def join_arguments(args: List[str]) -> str:
+    # shlex.join leaves arguments made of safe characters unquoted, in which
+    # case joining them with spaces gives the same result
+    command = " ".join(args)
+    if (
+        all(args)
+        and command.count(" ") == len(args) - 1
+        and not _SHELL_UNSAFE.search(command)
+    ):
+        return command
+    return shlex.join(args)
+
+
+def unquote(match: Match[str]) -> str:
+    escaped, single, double = match.groups()
+    if escaped is not None:
+        return escaped
+    if single is not None:
+        return single
+    return _DOUBLE_QUOTED_ESCAPE.sub(r"\1", double)
+
+
+def split_command(command: str) -> List[str]:
+    # Like the shell, backslashes are only interpreted in commands that quote
+    # their arguments, the others are split on whitespace
+    if "'" not in command and '"' not in command:
+        return command.split()
+
+    arguments = []
+    for word, stray in _SHELL_WORD.findall(command):
+        if stray:
+            return shlex.split(command)
+        arguments.append(_SHELL_QUOTING.sub(unquote, word))
+    return arguments
+
+
+def to_command(entry: Any) -> Any:
+    if args := entry.get("arguments"):
+        entry["command"] = join_arguments(args)
+        del entry["arguments"]
+    return entry
+
+
+def to_arguments(entry: Any) -> Any:
+    if command := entry.get("command"):
+        entry["arguments"] = split_command(command)
+        del entry["command"]
+    return entry
+
+
+def split_includes(s: str) -> List[str]:
+    # -I/path is split into -I and /path, the flags don't prefix each other
+    for flag in _INCLUDE_PREFIXES:
+        if s.startswith(flag) and len(s) > len(flag):
+            return [flag, s[len(flag) :]]
+    return [s]
+
+
+def normalize_entry(entry: Any) -> Any:
+    to_arguments(entry)
+
+    # The same compilers, flags and directories appear in most entries,
+    # sharing them shrinks the CDB in memory and when pickled for workers
+    arguments: List[str] = []
+    for arg in entry["arguments"]:
+        if arg.startswith(("-I", "-i")):
+            arguments.extend([sys.intern(x) for x in split_includes(arg)])
+        elif arg:
+            arguments.append(sys.intern(arg))
+
+    entry["arguments"] = arguments
+    if directory := entry.get("directory"):
+        entry["directory"] = sys.intern(directory)
+    return entry
+
+
+class EntryTransform(NamedTuple):
+    filter: Optional[Pattern]
+    replacement: str
+    literal: bool
+    flags: List[str]
+    compiler_prefix: Optional[str]
+    compiler: Optional[Callable[[str], str]]
+    include_directories_pattern: Optional[Pattern]
+    absolute_include_directories: bool
+    normalize_include_directories: bool
+    command: bool
+    normalized: bool = False
+
+    @property
+    def include_directories(self) -> bool:
+        return bool(
+            self.include_directories_pattern
+            or self.absolute_include_directories
+            or self.normalize_include_directories
+        )
+
+
+def transform_entry(transform: EntryTransform, entry: Any) -> Any:
+    if transform.filter:
+        if args := entry.get("arguments"):
+            command = join_arguments(args)
+            filtered = filter_command(
+                command, transform.filter, transform.replacement, transform.literal
+            )
+
+            # Keeping the arguments as is rather than splitting them back
+            if filtered != command:
+                entry["command"] = filtered
+                del entry["arguments"]
+        else:
+            entry["command"] = filter_command(
+                entry["command"],
+                transform.filter,
+                transform.replacement,
+                transform.literal,
+            )
+
+    # Entries loaded from the cache are already normalized
+    if not transform.normalized:
+        normalize_entry(entry)
+
+    arguments = entry["arguments"]
+    arguments.extend(transform.flags)
+
+    if transform.compiler_prefix:
+        arguments[0] = move_compiler(arguments[0], transform.compiler_prefix)
+
+    if transform.compiler:
+        arguments[0] = transform.compiler(arguments[0])
+
+    if transform.include_directories:
+        entry["arguments"] = transform_include_directories(
+            arguments,
+            entry["directory"] if transform.absolute_include_directories else "",
+            transform.include_directories_pattern,
+            transform.absolute_include_directories,
+            transform.normalize_include_directories,
+        )
+
+    if transform.command:
+        to_command(entry)
+
+    return entry
+
+
+def transform_chunk(transform: EntryTransform, chunk: List[Any]) -> List[Any]:
+    return [transform_entry(transform, entry) for entry in chunk]
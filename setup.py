@@ -0,0 +1,13 @@
+import os
+
+from setuptools import setup
+
+# The per-entry transformations can be compiled to a C extension with mypyc,
+# e.g. COMPILE_COMMANDS_USE_MYPYC=1 pip install --no-build-isolation .
+ext_modules = []
+if os.environ.get("COMPILE_COMMANDS_USE_MYPYC") == "1":
+    from mypyc.build import mypycify
+
+    ext_modules = mypycify(["compile_commands/transform.py"])
+
+setup(ext_modules=ext_modules)